@@ -11,6 +11,7 @@ from datetime import datetime
 from pathlib import Path
 import uuid
 from dotenv import load_dotenv
+from prompt_cache import GeminiContextClient, PromptCache, TokenBudget, extract_usage
 
 # Load environment variables from .env file
 load_dotenv()
@@ -34,7 +35,31 @@ if not GEMINI_API_KEY:
 genai.configure(api_key=GEMINI_API_KEY)
 
 # Initialize Gemini models with different configurations
-model = genai.GenerativeModel("gemini-2.0-flash-exp")
+MODEL_NAME = "gemini-2.0-flash-exp"
+model = genai.GenerativeModel(MODEL_NAME)
+
+# Static prompt templates are registered once as cached context where the API
+# supports it, otherwise they are sent as system instructions. Explicit caching
+# needs a stable versioned model and a template of at least MIN_CACHEABLE_TOKENS;
+# none of the current templates qualify, so they are sent as system instructions
+CONTEXT_CACHE_TTL_SECONDS = 3600
+MIN_CACHEABLE_TOKENS = 4096
+gemini_client = GeminiContextClient(genai)
+prompt_cache = PromptCache(
+    gemini_client, MODEL_NAME, MIN_CACHEABLE_TOKENS, ttl_seconds=CONTEXT_CACHE_TTL_SECONDS
+)
+
+def count_tokens(text: str) -> int:
+    return gemini_client.count_tokens(MODEL_NAME, text)
+
+# Token budgets for user input, oversized prompts are trimmed before sending
+CHAT_INPUT_TOKEN_BUDGET = 4000
+CODE_GENERATION_INPUT_TOKEN_BUDGET = 8000
+ENHANCE_PROMPT_INPUT_TOKEN_BUDGET = 2000
+
+chat_budget = TokenBudget(count_tokens, CHAT_INPUT_TOKEN_BUDGET)
+code_generation_budget = TokenBudget(count_tokens, CODE_GENERATION_INPUT_TOKEN_BUDGET)
+enhance_prompt_budget = TokenBudget(count_tokens, ENHANCE_PROMPT_INPUT_TOKEN_BUDGET)
 
 # Generation configs
 CHAT_CONFIG = {
@@ -59,17 +84,26 @@ ENHANCE_PROMPT_CONFIG = {
 }
 
 # Pydantic models for request/response
+class TokenUsage(BaseModel):
+    input_tokens: int = 0
+    cached_input_tokens: int = 0
+    output_tokens: int = 0
+    total_tokens: int = 0
+    input_trimmed: bool = False
+
 class ChatRequest(BaseModel):
     prompt: str
 
 class ChatResponse(BaseModel):
     result: str
+    usage: Optional[TokenUsage] = None
 
 class EnhancePromptRequest(BaseModel):
     prompt: str
 
 class EnhancePromptResponse(BaseModel):
     enhancedPrompt: str
+    usage: Optional[TokenUsage] = None
 
 class CodeGenerationRequest(BaseModel):
     prompt: str
@@ -116,6 +150,11 @@ async def root():
 async def health_check():
     return {"status": "healthy"}
 
+@app.on_event("shutdown")
+async def release_prompt_cache():
+    """Delete cached prompt context so it doesn't linger until its TTL expires"""
+    prompt_cache.release_all()
+
 # Simple file-based storage for projects
 PROJECTS_DIR = "projects"
 PROJECTS_FILE = os.path.join(PROJECTS_DIR, "projects.json")
@@ -234,22 +273,28 @@ You are a prompt enhancement expert and website designer(React + vite). Your tas
 Return only the enhanced prompt as plain text without any JSON formatting or additional explanations.
 """
 
+CODE_GEN_SYSTEM_INSTRUCTION = CODE_GEN_PROMPT + "\n\nIMPORTANT: Return ONLY valid JSON format as specified in the schema above."
+
+def generate_from_template(key: str, template: str, generation_config: Dict[str, Any], budget: TokenBudget, prompt: str):
+    """Send the user prompt against a static template and report token usage"""
+    user_input, trimmed = budget.fit(prompt)
+    response = prompt_cache.generate(key, template, generation_config, user_input)
+    usage = TokenUsage(**extract_usage(response), input_trimmed=trimmed)
+    print(
+        f"[{key}] tokens in={usage.input_tokens} cached={usage.cached_input_tokens} "
+        f"out={usage.output_tokens} trimmed={usage.input_trimmed}"
+    )
+    return response, usage
+
 @app.post("/api/ai-chat", response_model=ChatResponse)
 async def ai_chat(request: ChatRequest):
     """General AI chat functionality - processes user prompts through Gemini AI"""
     try:
-        # Create model with generation config
-        chat_model = genai.GenerativeModel(
-            "gemini-2.0-flash-exp",
-            generation_config=genai.GenerationConfig(**CHAT_CONFIG)
-        )
-        
-        # Combine the user prompt with the chat prompt template
-        full_prompt = request.prompt + " " + CHAT_PROMPT
-        response = chat_model.generate_content(full_prompt)
+        # The chat prompt template is the system instruction, the user prompt is the content
+        response, usage = generate_from_template("ai-chat", CHAT_PROMPT, CHAT_CONFIG, chat_budget, request.prompt)
         ai_response = response.text
         
-        return ChatResponse(result=ai_response)
+        return ChatResponse(result=ai_response, usage=usage)
     
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"AI chat error: {str(e)}")
@@ -258,17 +303,14 @@ async def ai_chat(request: ChatRequest):
 async def enhance_prompt(request: EnhancePromptRequest):
     """Prompt enhancement - takes user input and enhances it using predefined rules"""
     try:
-        # Create model with generation config
-        enhance_model = genai.GenerativeModel(
-            "gemini-2.0-flash-exp",
-            generation_config=genai.GenerationConfig(**ENHANCE_PROMPT_CONFIG)
+        # The enhancement rules are the system instruction, only the original prompt is sent
+        response, usage = generate_from_template(
+            "enhance-prompt", ENHANCE_PROMPT_RULES, ENHANCE_PROMPT_CONFIG, enhance_prompt_budget,
+            f"Original prompt: {request.prompt}"
         )
-        
-        enhanced_prompt_request = f"{ENHANCE_PROMPT_RULES}\n\nOriginal prompt: {request.prompt}"
-        response = enhance_model.generate_content(enhanced_prompt_request)
         enhanced_text = response.text.strip()
         
-        return EnhancePromptResponse(enhancedPrompt=enhanced_text)
+        return EnhancePromptResponse(enhancedPrompt=enhanced_text, usage=usage)
     
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Prompt enhancement error: {str(e)}")
@@ -277,15 +319,11 @@ async def enhance_prompt(request: EnhancePromptRequest):
 async def generate_ai_code(request: CodeGenerationRequest):
     """Code generation - converts prompts to React code with structured JSON output"""
     try:
-        # Create model with generation config for JSON output
-        code_model = genai.GenerativeModel(
-            "gemini-2.0-flash-exp",
-            generation_config=genai.GenerationConfig(**CODE_GENERATION_CONFIG)
+        # The code generation template is the system instruction, the user prompt is the content
+        response, usage = generate_from_template(
+            "gen-ai-code", CODE_GEN_SYSTEM_INSTRUCTION, CODE_GENERATION_CONFIG, code_generation_budget,
+            request.prompt
         )
-        
-        # Combine the user prompt with the code generation prompt template
-        full_prompt = request.prompt + " " + CODE_GEN_PROMPT + "\n\nIMPORTANT: Return ONLY valid JSON format as specified in the schema above."
-        response = code_model.generate_content(full_prompt)
         ai_response = response.text
         
         # Clean the response to extract JSON
@@ -299,13 +337,17 @@ async def generate_ai_code(request: CodeGenerationRequest):
         # Parse JSON response
         try:
             json_response = json.loads(cleaned_response)
+            # Never overwrite a "usage" key that is part of the generated project
+            if isinstance(json_response, dict) and "usage" not in json_response:
+                json_response["usage"] = usage.model_dump()
             return json_response
         except json.JSONDecodeError:
             # If JSON parsing fails, return a structured error
             return {
                 "error": "Failed to parse AI response as JSON",
                 "raw_response": ai_response,
-                "cleaned_response": cleaned_response
+                "cleaned_response": cleaned_response,
+                "usage": usage.model_dump()
             }
     
     except Exception as e:
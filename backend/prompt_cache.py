@@ -0,0 +1,238 @@
+"""
+Prompt context caching and token budgeting for the Gemini endpoints.
+
+The static prompt templates are sent as system instructions so they form a
+stable prefix ahead of the user text. A template that reaches the explicit
+caching minimum is registered once as cached content and every call references
+it by name instead of resending it; smaller templates are sent as is.
+"""
+
+import time
+from datetime import timedelta
+from typing import Any, Callable, Dict, Optional, Tuple
+
+# Attempts at rescaling oversized input before falling back to a hard cut
+MAX_TRIM_ATTEMPTS = 5
+
+TRIM_MARKER = "\n\n[... input trimmed to fit the token budget ...]\n\n"
+
+
+class GeminiContextClient:
+    """Adapter between PromptCache and the google.generativeai module"""
+
+    def __init__(self, genai_module):
+        self.genai = genai_module
+
+    def create_cache(self, model_name: str, system_instruction: str, ttl_seconds: int):
+        return self.genai.caching.CachedContent.create(
+            model=model_name,
+            system_instruction=system_instruction,
+            ttl=timedelta(seconds=ttl_seconds),
+        )
+
+    def delete_cache(self, handle):
+        handle.delete()
+
+    def model_from_cache(self, handle, generation_config: Dict[str, Any]):
+        return self.genai.GenerativeModel.from_cached_content(
+            handle,
+            generation_config=self.genai.GenerationConfig(**generation_config),
+        )
+
+    def model_with_instruction(self, model_name: str, system_instruction: str, generation_config: Dict[str, Any]):
+        return self.genai.GenerativeModel(
+            model_name,
+            system_instruction=system_instruction,
+            generation_config=self.genai.GenerationConfig(**generation_config),
+        )
+
+    def count_tokens(self, model_name: str, text: str) -> int:
+        return self.genai.GenerativeModel(model_name).count_tokens(text).total_tokens
+
+    def generate(self, model, contents: str):
+        return model.generate_content(contents)
+
+    def is_stale_cache_error(self, error: Exception) -> bool:
+        """
+        A cached content that expired or was evicted server side is reported as
+        403 "CachedContent not found (or permission denied)", sometimes as NotFound
+        """
+        from google.api_core import exceptions as google_exceptions
+        if isinstance(error, google_exceptions.NotFound):
+            return True
+        return isinstance(error, google_exceptions.PermissionDenied) and "cachedcontent" in str(error).lower()
+
+
+class PromptCache:
+    """Registers static templates as cached context once and hands out models bound to them"""
+
+    def __init__(
+        self,
+        client,
+        model_name: str,
+        min_cacheable_tokens: int,
+        ttl_seconds: int = 3600,
+        refresh_margin_seconds: int = 60,
+        clock: Callable[[], float] = time.time,
+    ):
+        self.client = client
+        self.model_name = model_name
+        self.min_cacheable_tokens = min_cacheable_tokens
+        self.ttl_seconds = ttl_seconds
+        self.refresh_margin_seconds = refresh_margin_seconds
+        self.clock = clock
+        self._entries: Dict[str, Dict[str, Any]] = {}
+        # Whether each template can be cached at all, decided once per key
+        self._eligible: Dict[str, bool] = {}
+
+    def is_eligible(self, key: str, system_instruction: str) -> bool:
+        """Check once whether the template is large enough to be cached"""
+        if key not in self._eligible:
+            # Heuristic: English prose averages several characters per token, so a
+            # template shorter than the minimum in characters is rejected without
+            # a count_tokens round trip
+            eligible = len(system_instruction) >= self.min_cacheable_tokens
+            if eligible:
+                try:
+                    eligible = self.client.count_tokens(self.model_name, system_instruction) >= self.min_cacheable_tokens
+                except Exception as e:
+                    print(f"Token counting failed for '{key}': {e}")
+                    eligible = False
+            if not eligible:
+                print(f"Template '{key}' is not cached, using system instruction")
+            self._eligible[key] = eligible
+        return self._eligible[key]
+
+    def get_handle(self, key: str, system_instruction: str):
+        """Return a live cache handle for the template, creating one if needed"""
+        if not self.is_eligible(key, system_instruction):
+            return None
+
+        now = self.clock()
+        entry = self._entries.get(key)
+        if entry and entry["expires_at"] - self.refresh_margin_seconds > now:
+            return entry["handle"]
+
+        # A handle that is about to expire is simply replaced; the server drops
+        # it once its TTL runs out, so no extra delete round trip is needed here
+        try:
+            handle = self.client.create_cache(self.model_name, system_instruction, self.ttl_seconds)
+        except Exception as e:
+            # Don't retry on every request, the template is sent as is from now on
+            print(f"Context caching unavailable for '{key}', using system instruction: {e}")
+            self._entries.pop(key, None)
+            self._eligible[key] = False
+            return None
+
+        self._entries[key] = {"handle": handle, "expires_at": now + self.ttl_seconds}
+        return handle
+
+    def get_model(self, key: str, system_instruction: str, generation_config: Dict[str, Any]):
+        """Return a model for the template, backed by cached context when available"""
+        handle = self.get_handle(key, system_instruction)
+        if handle is None:
+            return self.client.model_with_instruction(self.model_name, system_instruction, generation_config)
+        return self.client.model_from_cache(handle, generation_config)
+
+    def is_cached(self, key: str) -> bool:
+        return key in self._entries
+
+    def invalidate(self, key: str):
+        """Forget the handle for a template so the next call registers it again"""
+        self._entries.pop(key, None)
+
+    def generate(self, key: str, system_instruction: str, generation_config: Dict[str, Any], contents: str):
+        """Generate content for the template, re-registering the cache once if it went stale"""
+        model = self.get_model(key, system_instruction, generation_config)
+        try:
+            return self.client.generate(model, contents)
+        except Exception as e:
+            if not self.is_cached(key) or not self.client.is_stale_cache_error(e):
+                raise
+            self.invalidate(key)
+            model = self.get_model(key, system_instruction, generation_config)
+            return self.client.generate(model, contents)
+
+    def release_all(self):
+        """Delete every registered cache handle (called on shutdown)"""
+        for key, entry in list(self._entries.items()):
+            try:
+                self.client.delete_cache(entry["handle"])
+            except Exception as e:
+                print(f"Failed to delete cached context for '{key}': {e}")
+        self._entries.clear()
+
+
+class TokenBudget:
+    """Keeps user input within a token budget before it is sent to the model"""
+
+    def __init__(self, count_tokens: Callable[[str], int], max_input_tokens: int):
+        self.count_tokens = count_tokens
+        self.max_input_tokens = max_input_tokens
+
+    def estimate(self, text: str) -> int:
+        """Upper bound on the token count: byte-fallback tokenization yields at most one token per UTF-8 byte"""
+        return len(text.encode("utf-8"))
+
+    def measure(self, text: str) -> int:
+        """Exact token count, falling back to the upper bound if counting fails"""
+        try:
+            return self.count_tokens(text)
+        except Exception as e:
+            print(f"Token counting failed, using byte count: {e}")
+            return self.estimate(text)
+
+    def fit(self, text: str) -> Tuple[str, bool]:
+        """Return the text trimmed to the budget and whether it was trimmed"""
+        # Input whose upper bound is within the budget skips the count_tokens round trip
+        if self.estimate(text) <= self.max_input_tokens:
+            return text, False
+
+        tokens = self.measure(text)
+        if tokens <= self.max_input_tokens:
+            return text, False
+
+        # Rescale by the last measured chars-per-token ratio until the input fits
+        keep = len(text)
+        for _ in range(MAX_TRIM_ATTEMPTS):
+            keep = max(int(keep * self.max_input_tokens / max(tokens, 1) * 0.9), 1)
+            trimmed = trim_middle(text, keep)
+            tokens = self.measure(trimmed)
+            if tokens <= self.max_input_tokens:
+                return trimmed, True
+
+        return self.hard_cut(text), True
+
+    def hard_cut(self, text: str) -> str:
+        """Cut the text until its byte upper bound fits, keeping at least one character"""
+        keep = max(self.max_input_tokens - self.estimate(TRIM_MARKER), 1)
+        trimmed = trim_middle(text, keep)
+        while keep > 1 and self.estimate(trimmed) > self.max_input_tokens:
+            keep = max(min(keep * self.max_input_tokens // self.estimate(trimmed), keep - 1), 1)
+            trimmed = trim_middle(text, keep)
+        return trimmed
+
+
+def trim_middle(text: str, keep_chars: int) -> str:
+    """Keep the start and end of the text, which carry most of the intent of a prompt"""
+    if len(text) <= keep_chars:
+        return text
+    head = (keep_chars * 2) // 3
+    tail = keep_chars - head
+    return text[:head].rstrip() + TRIM_MARKER + (text[-tail:].lstrip() if tail else "")
+
+
+def extract_usage(response) -> Dict[str, int]:
+    """Read token usage from a Gemini response, defaulting to zero when absent"""
+    metadata = getattr(response, "usage_metadata", None)
+
+    def read(field: str) -> int:
+        value: Optional[int] = getattr(metadata, field, None) if metadata is not None else None
+        return int(value or 0)
+
+    return {
+        "input_tokens": read("prompt_token_count"),
+        "cached_input_tokens": read("cached_content_token_count"),
+        "output_tokens": read("candidates_token_count"),
+        "total_tokens": read("total_token_count"),
+    }
@@ -0,0 +1,301 @@
+#!/usr/bin/env python3
+"""
+Tests for prompt context caching and token budgeting
+Runs against a local fake client, no server or API key needed
+"""
+
+import sys
+
+from google.api_core import exceptions as google_exceptions
+
+from prompt_cache import GeminiContextClient, PromptCache, TokenBudget, extract_usage, TRIM_MARKER
+
+# Large enough to pass the fake client's cacheable minimum
+TEMPLATE = "template " * 50
+CHAT = "chat prompt " * 50
+
+
+class StaleCacheError(Exception):
+    pass
+
+
+class FakeHandle:
+    def __init__(self, name):
+        self.name = name
+
+
+class FakeClient:
+    """Records every call PromptCache makes instead of talking to Gemini"""
+
+    def __init__(self, fail_create=None, fail_count=False):
+        self.fail_create = fail_create
+        self.fail_count = fail_count
+        self.counted = []
+        self.created = []
+        self.deleted = []
+        self.generated = []
+        self.stale = set()
+
+    def create_cache(self, model_name, system_instruction, ttl_seconds):
+        if self.fail_create:
+            raise self.fail_create
+        handle = FakeHandle(f"cachedContents/{len(self.created)}")
+        self.created.append((handle, system_instruction, ttl_seconds))
+        return handle
+
+    def count_tokens(self, model_name, text):
+        if self.fail_count:
+            raise RuntimeError("count_tokens unavailable")
+        self.counted.append(text)
+        return len(text) // 2
+
+    def delete_cache(self, handle):
+        self.deleted.append(handle.name)
+
+    def model_from_cache(self, handle, generation_config):
+        return ("cached", handle.name)
+
+    def model_with_instruction(self, model_name, system_instruction, generation_config):
+        return ("instruction", system_instruction)
+
+    def generate(self, model, contents):
+        if model[0] == "cached" and model[1] in self.stale:
+            raise StaleCacheError(model[1])
+        self.generated.append((model, contents))
+        return model
+
+    def is_stale_cache_error(self, error):
+        return isinstance(error, StaleCacheError)
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def make_cache(client, clock):
+    return PromptCache(
+        client, "gemini-test", min_cacheable_tokens=100, ttl_seconds=600, refresh_margin_seconds=60, clock=clock
+    )
+
+
+def test_template_registered_once():
+    client, clock = FakeClient(), FakeClock()
+    cache = make_cache(client, clock)
+
+    first = cache.get_model("gen-ai-code", TEMPLATE, {})
+    clock.now += 300
+    second = cache.get_model("gen-ai-code", TEMPLATE, {})
+
+    assert first == second == ("cached", "cachedContents/0")
+    assert len(client.created) == 1
+    assert client.created[0][1:] == (TEMPLATE, 600)
+    assert client.counted == [TEMPLATE]
+
+
+def test_handle_refreshed_before_expiry():
+    client, clock = FakeClient(), FakeClock()
+    cache = make_cache(client, clock)
+
+    cache.get_model("gen-ai-code", TEMPLATE, {})
+    clock.now += 550
+    model = cache.get_model("gen-ai-code", TEMPLATE, {})
+
+    assert model == ("cached", "cachedContents/1")
+    assert len(client.created) == 2
+
+
+def test_small_template_never_creates_cache():
+    client, clock = FakeClient(), FakeClock()
+    cache = make_cache(client, clock)
+
+    # Shorter than the minimum in characters: rejected without counting
+    assert cache.get_model("ai-chat", "tiny", {}) == ("instruction", "tiny")
+    # Long enough in characters but below the minimum in tokens: counted once
+    medium = "x" * 150
+    for _ in range(3):
+        clock.now += 600
+        assert cache.get_model("enhance-prompt", medium, {}) == ("instruction", medium)
+
+    assert client.created == []
+    assert client.counted == [medium]
+
+
+def test_counting_failure_skips_caching():
+    client, clock = FakeClient(fail_count=True), FakeClock()
+    cache = make_cache(client, clock)
+
+    assert cache.get_model("gen-ai-code", TEMPLATE, {}) == ("instruction", TEMPLATE)
+    client.fail_count = False
+    assert cache.get_model("gen-ai-code", TEMPLATE, {}) == ("instruction", TEMPLATE)
+    assert client.created == []
+
+
+def test_create_failure_falls_back_without_retrying():
+    client, clock = FakeClient(fail_create=RuntimeError("model not supported")), FakeClock()
+    cache = make_cache(client, clock)
+
+    assert cache.get_model("ai-chat", CHAT, {}) == ("instruction", CHAT)
+    assert not cache.is_cached("ai-chat")
+
+    client.fail_create = None
+    clock.now += 6000
+    assert cache.get_model("ai-chat", CHAT, {}) == ("instruction", CHAT)
+    assert client.created == []
+
+
+def test_stale_handle_is_recreated_and_retried():
+    client, clock = FakeClient(), FakeClock()
+    cache = make_cache(client, clock)
+
+    cache.generate("gen-ai-code", TEMPLATE, {}, "first")
+    client.stale.add("cachedContents/0")
+    result = cache.generate("gen-ai-code", TEMPLATE, {}, "second")
+
+    assert result == ("cached", "cachedContents/1")
+    assert client.generated[-1] == (("cached", "cachedContents/1"), "second")
+
+
+def test_adapter_classifies_stale_cache_errors():
+    client = GeminiContextClient(genai_module=None)
+
+    assert client.is_stale_cache_error(
+        google_exceptions.PermissionDenied("CachedContent not found (or permission denied)")
+    )
+    assert client.is_stale_cache_error(google_exceptions.NotFound("cachedContents/abc"))
+    assert not client.is_stale_cache_error(google_exceptions.PermissionDenied("API key not valid"))
+    assert not client.is_stale_cache_error(google_exceptions.InvalidArgument("bad request"))
+    assert not client.is_stale_cache_error(RuntimeError("CachedContent"))
+
+
+def test_release_all_deletes_handles():
+    client, clock = FakeClient(), FakeClock()
+    cache = make_cache(client, clock)
+
+    cache.get_model("gen-ai-code", TEMPLATE, {})
+    cache.get_model("enhance-prompt", CHAT, {})
+    cache.release_all()
+
+    assert sorted(client.deleted) == ["cachedContents/0", "cachedContents/1"]
+    assert not cache.is_cached("gen-ai-code")
+
+
+def test_budget_skips_counting_for_short_input():
+    calls = []
+
+    def count(text):
+        calls.append(text)
+        return len(text)
+
+    budget = TokenBudget(count, max_input_tokens=100)
+    assert budget.fit("short prompt") == ("short prompt", False)
+    assert calls == []
+
+
+def test_budget_trims_oversized_input():
+    budget = TokenBudget(lambda text: len(text.split()), max_input_tokens=50)
+    text = "start " + "filler " * 200 + "end"
+
+    trimmed, was_trimmed = budget.fit(text)
+
+    assert was_trimmed
+    assert len(trimmed.split()) <= 50
+    assert trimmed.startswith("start")
+    assert trimmed.endswith("end")
+    assert TRIM_MARKER.strip() in trimmed
+
+
+def test_budget_counts_dense_input_over_budget():
+    # One token per character, as for CJK text
+    budget = TokenBudget(len, max_input_tokens=2000)
+
+    trimmed, was_trimmed = budget.fit("字" * 3999)
+
+    assert was_trimmed
+    assert len(trimmed) <= 2000
+
+
+def test_budget_trims_input_above_one_token_per_char():
+    budget = TokenBudget(lambda text: 3 * len(text), max_input_tokens=300)
+
+    trimmed, was_trimmed = budget.fit("start " + "あ" * 2000 + " end")
+
+    assert was_trimmed
+    assert 3 * len(trimmed) <= 300
+    assert trimmed.startswith("start")
+
+
+def test_budget_counts_dense_input_under_budget_in_chars():
+    # Byte-fallback characters can cost several tokens each
+    budget = TokenBudget(lambda text: 3 * len(text), max_input_tokens=300)
+
+    trimmed, was_trimmed = budget.fit("あ" * 200)
+
+    assert was_trimmed
+    assert 0 < 3 * len(trimmed) <= 300
+
+
+def test_budget_hard_cuts_when_counting_does_not_converge():
+    # A counter that never reports the input as within budget
+    budget = TokenBudget(lambda text: 10 ** 6, max_input_tokens=100)
+
+    trimmed, was_trimmed = budget.fit("start " + "filler " * 200 + "end")
+
+    assert was_trimmed
+    assert len(trimmed.encode("utf-8")) <= 100
+    assert trimmed.startswith("start")
+    assert trimmed.replace(TRIM_MARKER, "").strip()
+
+
+def test_budget_uses_upper_bound_when_counting_fails():
+    def count(text):
+        raise RuntimeError("count_tokens unavailable")
+
+    budget = TokenBudget(count, max_input_tokens=100)
+
+    trimmed, was_trimmed = budget.fit("a" * 500)
+
+    assert was_trimmed
+    assert len(trimmed) <= 100
+
+
+def test_extract_usage():
+    class Metadata:
+        prompt_token_count = 120
+        cached_content_token_count = 100
+        candidates_token_count = 30
+        total_token_count = 150
+
+    class Response:
+        usage_metadata = Metadata()
+
+    assert extract_usage(Response()) == {
+        "input_tokens": 120,
+        "cached_input_tokens": 100,
+        "output_tokens": 30,
+        "total_tokens": 150,
+    }
+    assert extract_usage(object())["total_tokens"] == 0
+
+
+def main():
+    """Run all tests"""
+    tests = [value for name, value in sorted(globals().items()) if name.startswith("test_")]
+    failed = 0
+    for test in tests:
+        try:
+            test()
+            print(f"✅ {test.__name__}")
+        except AssertionError as e:
+            failed += 1
+            print(f"❌ {test.__name__}: {e}")
+
+    print(f"📊 Test Results: {len(tests) - failed}/{len(tests)} tests passed")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()